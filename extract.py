@@ -6,14 +6,17 @@ Extract words out of a book/text and get their definitions.
 import argparse
 import codecs
 import collections
+import io
 import sys
 import json
+import multiprocessing
 import os
 import re
+import time
 import zipfile
-from typing import Dict
+from typing import Dict, List, Tuple
 
-from nltk import tokenize, WordNetLemmatizer
+from nltk import WordNetLemmatizer
 from nltk.corpus.reader import wordnet
 
 import reverse_data
@@ -23,6 +26,17 @@ import reverse_data
 
 MIN_WORD_LEN = 1
 SEP = '|||'
+# Matches words made of (Unicode) letters, including ones with apostrophes or
+# hyphens inside like "o'clock" or "well-known", which are dictionary entries.
+# `[^\W\d_]` is word characters minus decimal digits and "_", i.e., letters
+# but also numerics such as "²" or "½", which are removed when pruning.
+_WORD_RE = re.compile(r"[^\W\d_]+(?:['-][^\W\d_]+)*")
+# Number of unique words handed to a lemmatization worker at once.
+LEMMA_CHUNK_SIZE = 2000
+# Number of characters of the text encoded and written to the zip at once.
+WRITE_CHUNK_SIZE = 1 << 20
+
+_LEMMA = WordNetLemmatizer()
 
 
 def main():
@@ -91,18 +105,49 @@ def _write_filtered_dict(words: set,
                          scores: Dict[str, float],
                          text: str,
                          output_path: str):
-  filtered_word_dict = word_dict.filtered(words)
-  dict_of_str = {key: entry.content for key, entry in filtered_word_dict.items()}
+  # Same result as `word_dict.filtered(words)`, but built in a single pass
+  # without creating an intermediate WordDictionary.
+  d, links = word_dict.d, word_dict.links
+  dict_of_str = {}
+  filtered_links = {}
+  for w in words:
+    entry = d.get(w)
+    if entry is None:
+      entry = d[links[w]]  # May raise!
+    dict_of_str[w] = entry.content
+    if w in links:
+      filtered_links[w] = links[w]
   master_object = {
     'definitions': dict_of_str,
-    'links': filtered_word_dict.links,
+    'links': filtered_links,
     'scores': scores}
 
   # Write definitions as JSON
   os.makedirs(os.path.dirname(output_path), exist_ok=True)
-  with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-    zf.writestr('master.json', json.dumps(master_object).encode('utf-8'))
-    zf.writestr('fulltext.txt', text.encode('utf-8'))
+  # Entries are streamed into the zip to avoid holding the full JSON string
+  # and its encoded bytes in memory at the same time.
+  # Level 1 is several times faster than the default level 6 and the output
+  # is only slightly larger.
+  with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED,
+                       compresslevel=1) as zf:
+    with zf.open(_zip_info(zf, 'master.json'), 'w', force_zip64=True) as raw, \
+        io.TextIOWrapper(raw, encoding='utf-8') as f:
+      json.dump(master_object, f, ensure_ascii=False, separators=(',', ':'))
+    with zf.open(_zip_info(zf, 'fulltext.txt'), 'w', force_zip64=True) as f:
+      for i in range(0, len(text), WRITE_CHUNK_SIZE):
+        f.write(text[i:i + WRITE_CHUNK_SIZE].encode('utf-8'))
+
+
+def _zip_info(zf: zipfile.ZipFile, name: str) -> zipfile.ZipInfo:
+  """Return a ZipInfo for a new member `name` of `zf`, like `writestr` makes.
+
+  `ZipFile.open` stamps bare names with 1980-01-01 and a ZipInfo is stored
+  uncompressed by default, so we set the time and compression ourselves.
+  """
+  zinfo = zipfile.ZipInfo(name, time.localtime()[:6])
+  zinfo.compress_type = zf.compression
+  zinfo._compresslevel = zf.compresslevel
+  return zinfo
 
 
 def _get_scores(word_counts: Dict[str, int],
@@ -113,14 +158,14 @@ def _get_scores(word_counts: Dict[str, int],
   1. Set score := how often does w occur in the text
      (as given by `word_counts`).
   2. If the word is said to be "literary" in the dict, divide score by 2.
+     This is looked up in `word_dict.literary`.
 
   Overall, lower score means "rarer" words.
   """
-  scores = {word: count for word, count in word_counts.items()}
-  for word in word_counts:
-    if 'literary' in word_dict[word].get_info():
-      scores[word] /= 2
-  return scores
+  d, links, literary = word_dict.d, word_dict.links, word_dict.literary
+  # Resolve links the same way `WordDictionary.__getitem__` does.
+  return {w: (c / 2 if (w if w in d else links[w]) in literary else c)
+          for w, c in word_counts.items()}
 
 
 def _get_word_counts(text: str,
@@ -128,43 +173,42 @@ def _get_word_counts(text: str,
   """Given a text and a dictionary, split the text into words and return counts.
 
   Done by:
-  1. Sanitize text by doing lower case and removing newlines.
-  2. Use NLTK's tokenizer
+  1. Sanitize text by doing lower case.
+  2. Split into words with a regex.
   3. Try to find the base by using NLTK's lemmatizer (i.e. houses -> house),
      to increase chances of finding a word in the dictionary
   4. Count the occurences of words.
   """
+  # Newlines need no special treatment, the tokenizer below splits on them
+  # like on any other non-letter.
   text = text.lower()
 
-  print('Collapsing newlines...')
-  text = re.sub('(.)\n', r'\1 ', text)
-
   print('Tokenizing...')
-  words = tokenize.word_tokenize(text)
+  # A single regex pass yields words, possibly joined by apostrophes or
+  # hyphens (e.g. "o'clock", "well-known"). Punctuation, numbers and quotes never make it into
+  # a token, and abbreviations such as "e.g." fall apart into single letters.
+  words = _WORD_RE.findall(text)
 
-  print('Pruning...')
-
-  # Remove punctuation in tokens, as ntlk tokenizes for example "they'll" as
-  # [they, 'll]. The resulting "ll" will be ditched in a later stage.
-  # Also removes tokens that are just quotes, which turn into empty tokens,
-  # removed at the MIN_WORD_LEN stage below.
-  words = (w.strip("'.-`\"") for w in words)
-  # Ditches some genitives and third person singulars. In Python 3.9 this
-  # should be `removesuffix` but the `replace` works well enough in this context.
-  words = (w.replace("'s", '') for w in words)
-  # Removes abbreviations such as "e.g."
-  words = (w for w in words if '.' not in w)
-  # Removes most punctuation from the list, such as ",", ":", etc.,
-  # also removes empty tokens.
-  words = (w for w in words if len(w) > MIN_WORD_LEN)
-  # Removes all numbers
-  words = (w for w in words if w and not all(c.isdigit() for c in w))
-  
   print('Counting...')
-  word_counts = collections.Counter(words)
+  # Count the raw tokens first, so that the pruning below only runs once per
+  # unique token instead of once per occurrence.
+  raw_counts = collections.Counter(words)
+
+  print('Pruning...')
+  word_counts = collections.Counter()
+  for w, count in raw_counts.items():
+    # Ditches some genitives and third person singulars.
+    if w.endswith("'s"):
+      w = w[:-2]
+    # Removes single letters, and tokens containing numerics such as "²".
+    if len(w) > MIN_WORD_LEN and w.replace("'", '').replace('-', '').isalpha():
+      word_counts[w] += count
 
   print('Lemmatizing...')
-  lemma = WordNetLemmatizer()
+  # Workers only need to test membership, so ship them a frozenset of keys
+  # instead of the whole WordDictionary. This is everything
+  # `WordDictionary.__contains__` would accept, materialized once.
+  dict_keys = frozenset(word_dict.d.keys() | word_dict.links.keys())
   word_counts_lemmad = collections.defaultdict(int)
 
   # We create a map from word_as_it_appears_in_book to the lemmad
@@ -172,19 +216,50 @@ def _get_word_counts(text: str,
   # word_as_it_appears_in_book due to the preprocessing above but oh well.
   links = {}
 
+  # Every word is processed independently, so we fan out over processes and
+  # merge the partial results here.
+  with multiprocessing.Pool(initializer=_init_lemmatize_worker,
+                            initargs=(dict_keys,)) as pool:
+    for local_counts, local_links in pool.imap_unordered(
+        _lemmatize_chunk, _chunks(list(word_counts.items()), LEMMA_CHUNK_SIZE)):
+      # Results come back as fresh unpickled strings, intern them so that
+      # the counts, links and scores built from them share one copy per word.
+      for w, count in local_counts.items():
+        word_counts_lemmad[sys.intern(w)] += count
+      for w, linked_w in local_links.items():
+        links[sys.intern(w)] = sys.intern(linked_w)
+
+  return word_counts_lemmad, links
+
+
+# Set in each worker process by `_init_lemmatize_worker`.
+_WORKER_DICT_KEYS = frozenset()
+
+
+def _init_lemmatize_worker(dict_keys: frozenset):
+  global _WORKER_DICT_KEYS
+  _WORKER_DICT_KEYS = dict_keys
+
+
+def _lemmatize_chunk(words_chunk: List[Tuple[str, int]]):
+  """Lemmatize a chunk of (word, count) tuples.
+
+  Returns a tuple (counts, links), where counts maps dictionary words to counts
+  and links maps words not in the dictionary to a lemmad form that is.
+  """
+  in_dict = _WORKER_DICT_KEYS.__contains__
+  word_counts_lemmad = collections.defaultdict(int)
+  links = {}
+
   # Note: assume we have `word_counts` = {"belongs": 4 "belonging":3}
   # This results in sth like {"belong": 7, "belonging": 7} in the following.
-  for w, count in word_counts.items():
-    possible_words = []
-    if w in word_dict:
-      possible_words.append(w)
-      word_is_in_dict = True
-    else:
-      word_is_in_dict = False
+  for w, count in words_chunk:
+    word_is_in_dict = in_dict(w)
+    possible_words = [w] if word_is_in_dict else []
 
     for t in wordnet.POS_LIST:
-      w_lemmad = lemma.lemmatize(w, pos=t)
-      if w_lemmad != w and w_lemmad in word_dict:
+      w_lemmad = _LEMMA.lemmatize(w, pos=t)
+      if w_lemmad != w and in_dict(w_lemmad):
         possible_words.append(w_lemmad)
 
     # Neither the input word nor any lemmad forms are in the dictionary.
@@ -201,7 +276,12 @@ def _get_word_counts(text: str,
     for possible_w in possible_words:
       word_counts_lemmad[possible_w] += count
 
-  return word_counts_lemmad, links
+  return dict(word_counts_lemmad), links
+
+
+def _chunks(seq, n):
+  for i in range(0, len(seq), n):
+    yield seq[i:i + n]
 
 
 if __name__ == '__main__':
@@ -11,14 +11,19 @@ The function that does the heavy lifting is _parse. Overview:
 
 """
 import argparse
+import atexit
 import collections
+import concurrent.futures
 import contextlib
+import html
 import itertools
+import mmap
 import os
 import pickle
+import re
 import shutil
 import zlib
-from typing import Dict, List, Tuple, Set
+from typing import Dict, List, Optional, Tuple, Set
 
 import lxml.etree as etree
 
@@ -43,6 +48,26 @@ XPATH_DERIVATIVES = '//span[contains(@class, "t_derivatives")]//' \
                     'span[contains(@class, "x_xoh")]/' \
                     'span[@role="text"]'
 
+# Compiled versions of the above, used by `Entry.get_special`.
+_COMPILED_XPATH_INFO = etree.XPath(XPATH_INFO)
+_COMPILED_XPATH_OTHER_WORDS = etree.XPath(XPATH_OTHER_WORDS)
+_COMPILED_XPATH_DERIVATIVES = etree.XPath(XPATH_DERIVATIVES)
+
+# Number of entries sent to a worker process at once in `_scan_entries`.
+SCAN_CHUNK_SIZE = 512
+
+# Number of bytes handed to zlib at once in `_parse`.
+DECOMPRESS_CHUNK_SIZE = 1 << 16
+
+# Matches the "d:title" attribute of an entry, which is the name of the entry.
+_TITLE_RE = re.compile(r'<d:entry\b[^>]*?\bd:title="([^"]*)"')
+
+# Shared parser for the trees we only run XPath queries against (see
+# `Entry.get_xml`). Dropping whitespace-only text gives smaller trees, so this
+# must not be used for trees that get rendered.
+_QUERY_PARSER = etree.XMLParser(collect_ids=False, remove_blank_text=True,
+                                huge_tree=False)
+
 OUTPUT_HTML_HEADER = """
 <html lang="en">
 <head>
@@ -113,17 +138,22 @@ class WordDictionary:
 
   @staticmethod
   def from_file(p):
-    d, links = parse(p)
-    return WordDictionary(d, links)
+    d, links, literary = parse(p)
+    # Copy the links, as `add_links` would otherwise modify the cached ones,
+    # which are only written to disk at exit.
+    return WordDictionary(d, dict(links), literary)
 
-  def __init__(self, d: Dict[str, 'Entry'], links: Dict[str, str]):
+  def __init__(self, d: Dict[str, 'Entry'], links: Dict[str, str],
+               literary: Optional[Set[str]] = None):
     """Constructor.
 
     :param d: The dictionary, as a dict mapping words to Entry instances.
     :param links: Special links, as a dict mapping words to words. Words `w` in
       this dict have a definition at `links[w]`.
+    :param literary: Words in `d` whose entry is marked as "literary".
     """
     self.d, self.links = d, links
+    self.literary = literary if literary is not None else set()
 
   def items(self):
     return self.d.items()
@@ -143,7 +173,7 @@ class WordDictionary:
       filtered_dict[w] = self[w]  # May raise!
       if w in self.links:
         filtered_links[w] = self.links[w]
-    return WordDictionary(filtered_dict, filtered_links)
+    return WordDictionary(filtered_dict, filtered_links, self.literary)
 
   def __getitem__(self, w) -> 'Entry':
     if w in self.d:
@@ -177,9 +207,9 @@ def parse(dictionary_path):
   # Some definitions have multiple entries (for example foil in NOAD).
   # Merge them here.
   entries = merge_same_keys(entries_tuples)
-  links = _get_links(dictionary_path, entries)
+  links, literary = _scan_entries(dictionary_path, entries)
   print(f'Links: {len(links)}')
-  return entries, links
+  return entries, links, literary
 
 
 def merge_same_keys(entries_tuples: List[Tuple[str, str]]) -> Dict[str, 'Entry']:
@@ -193,21 +223,37 @@ def merge_same_keys(entries_tuples: List[Tuple[str, str]]) -> Dict[str, 'Entry']
 
 
 def _pickle_cache(p):
-  """Little helper decorator to store stuff in a pickle cache, used below."""
+  """Little helper decorator to store stuff in a pickle cache, used below.
+
+  The cache is loaded on the first call, so importing this module stays cheap
+  (e.g. in worker processes). New results are written to `p` once when the
+  interpreter exits, rather than rewriting the whole cache after every call.
+  """
   def decorator(func):
-    if os.path.isfile(p):
-      with open(p, 'rb') as f:
-        cache = pickle.load(f)
-    else:
-      cache = {}
+    cache = None
+    dirty = False
+
+    def flush():
+      if not dirty:
+        return
+      with open(p, 'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    atexit.register(flush)
 
     def new_func(*args, **kwargs):
+      nonlocal cache, dirty
+      if cache is None:
+        if os.path.isfile(p):
+          with open(p, 'rb') as f:
+            cache = pickle.load(f)
+        else:
+          cache = {}
       key = args[0]
       if key not in cache:
         res = func(*args, **kwargs)
         cache[key] = res
-        with open(p, 'wb') as f:
-          pickle.dump(cache, f)
+        dirty = True
       else:
         print(f'Cached in {p}: {key}')
       return cache[key]
@@ -216,89 +262,145 @@ def _pickle_cache(p):
   return decorator
 
 
-@_pickle_cache('cache_links.pkl')
-def _get_links(p, entries):
+@_pickle_cache('cache_scan.pkl')
+def _scan_entries(p, entries) -> Tuple[Dict[str, str], Set[str]]:
+  """Return the links and the set of "literary" words of `entries`.
+
+  Both need the XML of every entry, so they are collected in the same pass.
+  """
   del p  # Only used for cache
   links = {}
+  literary = set()
   print('Getting links...')
-  for i, (key, entry) in enumerate(entries.items()):
-    if i % 1000 == 0:
-      progress = i / len(entries)
-      print(f'\rGetting links: {progress * 100:.1f}%', end='', flush=True)
-    for w in entry.get_words_and_derivaties():
-      if w in entries:
-        continue
-      # Word is not in dictionary, add to links
-      if w in links:
-        continue
-      links[w] = key
-  return links
+  # Parsing the XML of every entry is the expensive part and independent per
+  # entry, so it is done in worker processes. `map` keeps the order, so the
+  # result is the same as for a serial loop.
+  with concurrent.futures.ProcessPoolExecutor() as executor:
+    scanned = executor.map(_scan_entry,
+                           entries.values(),
+                           chunksize=SCAN_CHUNK_SIZE)
+    # Use the parent's keys rather than unpickled copies from the workers.
+    for i, (key, (words, is_literary)) in enumerate(zip(entries, scanned)):
+      if i % 1000 == 0:
+        progress = i / len(entries)
+        print(f'\rGetting links: {progress * 100:.1f}%', end='', flush=True)
+      if is_literary:
+        literary.add(key)
+      # Words not in the dictionary link to the first entry mentioning them.
+      # Note: `difference` is only fast for a set or dict argument, passing
+      # `entries.keys()` would walk all keys for every entry.
+      for w in words.difference(entries):
+        links.setdefault(w, key)
+  return links, literary
+
+
+def _scan_entry(entry: 'Entry') -> Tuple[Set[str], bool]:
+  """Helper for `_scan_entries`, runs in a worker process."""
+  return entry.get_words_and_derivaties(), 'literary' in entry.get_info()
 
 
 @_pickle_cache('cache_parse.pkl')
 def _parse(dictionary_path) -> List[Tuple[str, str]]:
   """Parse Body.data into a list of entries given as key, definition tuples."""
-  with open(dictionary_path, 'rb') as f:
-    content_bytes = f.read()
+  # Map the file instead of reading it, the OS pages it in as we go and
+  # zlib is handed views into the mapping rather than copies.
+  with open(dictionary_path, 'rb') as f, \
+      mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content_bytes, \
+      memoryview(content_bytes) as content_view:
+    return _parse_mapped(content_bytes, content_view)
+
+
+def _parse_mapped(content_bytes, content_view) -> List[Tuple[str, str]]:
+  """Implementation of `_parse`, given the mapped file and a view on it."""
   total_bytes = len(content_bytes)
 
   # The first zip file starts at ~100 bytes:
-  content_bytes = content_bytes[100:]
+  pos = 100
 
   first = True
   entries = []
   for i in itertools.count():
-    if not content_bytes:  # Backup condition in case stop is never True.
+    # Jump to the next candidate zlib header instead of probing every byte.
+    pos = _find_zlib_header(content_bytes, pos)
+    if pos < 0:  # Backup condition in case stop is never True.
       break
+    # Feed the stream in bounded windows until it ends, so that zlib copies at
+    # most one window into `unused_data`, rather than the rest of the file.
+    d = zlib.decompressobj()
+    parts = []
+    end = pos
     try:
-      d = zlib.decompressobj()
-      res = d.decompress(content_bytes)
-      new_entries, stop = _split(res, verbose=first)
-      entries += new_entries
-      if stop:
-        break
-      if i % 10 == 0:
-        bytes_left = len(content_bytes)  # Approximately...
-        progress = 1 - bytes_left / total_bytes
-        print(f'{progress * 100:.1f}% // '
-              f'{len(entries)} entries parsed // '
-              f'Latest entry: {entries[-1][0]}')
-      first = False
-
-      # Set content_bytes to the unused data so we can start the search for the
-      # next zip file.
-      content_bytes = d.unused_data
-
-    except zlib.error:  # Current content_bytes is not a zipfile -> skip a byte.
-      content_bytes = content_bytes[1:]
+      while not d.eof and end < total_bytes:
+        window_end = min(end + DECOMPRESS_CHUNK_SIZE, total_bytes)
+        parts.append(d.decompress(content_view[end:window_end]))
+        end = window_end
+    except zlib.error:  # Not a zipfile after all -> continue after this byte.
+      pos += 1
+      continue
+    res = b''.join(parts)
+
+    stop = _split(res, entries, verbose=first)
+    if stop:
+      break
+    if i % 10 == 0:
+      progress = pos / total_bytes
+      print(f'{progress * 100:.1f}% // '
+            f'{len(entries)} entries parsed // '
+            f'Latest entry: {entries[-1][0]}')
+    first = False
+
+    # Everything up to the unused data was consumed by the current zip file,
+    # the search for the next one starts after it.
+    pos = end - len(d.unused_data)
 
   return entries
 
 
-def _split(input_bytes, verbose) -> Tuple[List[Tuple[str, str]],
-                                          bool]:
-  """Split `input_bytes` into a list of tuples (name, definition)."""
+def _find_zlib_header(content_bytes, start) -> int:
+  """Return the offset of the next plausible zlib header at or after `start`.
+
+  A zlib stream starts with 0x78 (deflate, 32K window) followed by a flag byte
+  such that the two bytes, read as a big-endian int, are divisible by 31.
+  Returns -1 if no such header exists.
+  """
+  while True:
+    pos = content_bytes.find(b'\x78', start)
+    if pos < 0 or pos + 1 >= len(content_bytes):
+      return -1
+    if ((0x78 << 8) | content_bytes[pos + 1]) % 31 == 0:
+      return pos
+    start = pos + 1
+
+
+def _split(input_bytes,
+           entries: List[Tuple[str, str]],
+           verbose) -> bool:
+  """Split `input_bytes` into tuples (name, definition), appended to `entries`.
+
+  Returns whether the end of the dictionary was reached, i.e., whether parsing
+  should stop.
+  """
   printv = print if verbose else lambda *a, **k: ...
 
   # The first four bytes are always not UTF-8 (not sure why?)
-  input_bytes = input_bytes[4:]
+  # We walk through `input_bytes` by offset, `start` is where the current
+  # entry begins.
+  start = 4
 
   printv('Splitting...')
   printv(f'{"index": <10}', f'{"bytes": <30}', f'{"as chars"}',
          '-' * 50, sep='\n')
 
-  entries = []
-  total_offset = 0
   stop_further_parsing = False
 
   while True:
     # Find the next newline, which delimits the current entry.
     try:
-      next_offset = input_bytes.index('\n'.encode('utf-8'))
+      next_offset = input_bytes.index(b'\n', start)
     except ValueError:  # No more new-lines -> no more entries!
       break
 
-    entry_text = input_bytes[:next_offset].decode('utf-8')
+    entry_text = input_bytes[start:next_offset].decode('utf-8')
 
     # The final part of the dictionary contains some meta info, which we skip.
     # TODO: might only be for the NOAD, so check other dictionaries.
@@ -310,28 +412,25 @@ def _split(input_bytes, verbose) -> Tuple[List[Tuple[str, str]],
     # Make sure we have a valid entry.
     assert (entry_text.startswith('<d:entry') and
             entry_text.endswith('</d:entry>')), \
-      f'ENTRY: {entry_text} \n REM: {input_bytes}'
+      f'ENTRY: {entry_text} \n REM: {input_bytes[start:]}'
 
-    # The name of the definition is stored in the "d:title" attribute,
-    # where "d" is the current domain, which we get from the nsmap - the
-    # actual attribute will be "{com.apple.blabla}title" (including the
-    # curly brackets).
-    xml_entry = etree.fromstring(entry_text)
-    domain = xml_entry.nsmap['d']
-    key = '{%s}title' % domain
-    name = xml_entry.get(key)  # Lookup the attribute in the tree.
+    # The name of the definition is stored in the "d:title" attribute of the
+    # root <d:entry> element. We only need that attribute here, so we grab it
+    # with a regex instead of building an XML tree for every entry.
+    name = _TITLE_RE.match(entry_text).group(1)
+    if '&' in name:  # Undo XML escaping, e.g. "&amp;" -> "&".
+      name = html.unescape(name)
 
     entries.append((name, entry_text))
 
-    printv(f'{next_offset + total_offset: 10d}',
+    printv(f'{next_offset: 10d}',
            f'{str(input_bytes[next_offset + 1:next_offset + 5]): <30}',
-           xml_entry.get(key))
+           name)
 
     # There is always 4 bytes of chibberish between entries. Skip them
     # and the new lines (for a total of 5 bytes).
-    input_bytes = input_bytes[next_offset + 5:]
-    total_offset += next_offset
-  return entries, stop_further_parsing
+    start = next_offset + 5
+  return stop_further_parsing
 
 
 class Entry:
@@ -358,14 +457,14 @@ class Entry:
     self._multi_definition = True
     self.content += content
 
-  def get_xml_tree(self):
+  def get_xml_tree(self, parser=None):
     content = self.content
     if self._multi_definition:
       content = '<div>' + self.content + '</div>'
-    return etree.fromstring(content)
+    return etree.fromstring(content, parser)
 
-  def get_special(self, xpath, replace=None):
-    matches = self.get_xml().xpath(xpath)
+  def get_special(self, compiled_xpath: etree.XPath, replace=None):
+    matches = compiled_xpath(self.get_xml())
     if not matches:
       return []
     # Note: May be empty.
@@ -378,19 +477,21 @@ class Entry:
 
   def get_xml(self):
     if self._xml is None:
-      self._xml = self.get_xml_tree()
+      self._xml = self.get_xml_tree(_QUERY_PARSER)
     return self._xml
 
   def get_words_and_derivaties(self):
     def _make():
-      derivatives = set(self.get_special(XPATH_DERIVATIVES))
-      other_words = set(self.get_special(XPATH_OTHER_WORDS, [("the", "")]))
+      derivatives = set(self.get_special(_COMPILED_XPATH_DERIVATIVES))
+      other_words = set(self.get_special(_COMPILED_XPATH_OTHER_WORDS,
+                                         [("the", "")]))
       return (derivatives | other_words) - {self.key}
 
     return _lazy(self, "_words_and_derivatives", _make)
 
   def get_info(self):
-    return _lazy(self, "_info", lambda: set(self.get_special(XPATH_INFO)))
+    return _lazy(self, "_info",
+                 lambda: set(self.get_special(_COMPILED_XPATH_INFO)))
 
   def __str__(self):
     return f'Entry({self.key})'